@@ -1,5 +1,6 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any
 import os
@@ -8,6 +9,7 @@ from pathlib import Path
 from datetime import datetime
 
 from celery_tasks import celery_app, download_thread, get_task_info
+from snapshots import get_thread_at, get_thread_union, list_snapshots
 
 app = FastAPI(
     title="2ch Thread Downloader API",
@@ -19,6 +21,7 @@ app = FastAPI(
 class DownloadRequest(BaseModel):
     thread_id: Optional[str] = Field(None, description="ID треда для загрузки", example="123456")
     source_host: Optional[str] = Field(None, description="Домен источника (2ch.hk или 2ch.org)")
+    lazy: bool = Field(False, description="Сохранить только JSON и превью, оригиналы догружать по запросу")
 
 class DownloadResponse(BaseModel):
     task_id: str = Field(..., description="ID задачи Celery")
@@ -94,7 +97,8 @@ async def start_download(thread_id: str, body: Optional[DownloadRequest] = None)
     base_url = f'https://{source_host}' if source_host.startswith('2ch.') else 'https://2ch.org'
 
     # Запускаем задачу
-    task = download_thread.delay(thread_id, base_url)
+    lazy = body.lazy if body else False
+    task = download_thread.delay(thread_id, base_url, lazy)
     thread_tasks[thread_id] = task.id
     
     return DownloadResponse(
@@ -146,6 +150,9 @@ async def get_download_status(thread_id: str):
             try:
                 download_dir = Path(f'downloads/{thread_id}')
                 for file in download_dir.iterdir():
+                    # Служебные и недокачанные файлы начинаются с точки
+                    if file.name.startswith('.'):
+                        continue
                     if file.is_file() and file.suffix.lower() in {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}:
                         stats['photos'] += 1
                     elif file.is_file() and file.suffix.lower() in {'.mp4', '.webm', '.mov', '.avi', '.mkv'}:
@@ -207,17 +214,23 @@ async def get_download_status(thread_id: str):
     "/thread/{thread_id}",
     responses={
         200: {"description": "Информация о треде получена"},
-        404: {"model": ErrorResponse, "description": "Тред не найден"},
-        400: {"model": ErrorResponse, "description": "Неверный формат thread_id"}
+        404: {"model": ErrorResponse, "description": "Тред или снимок не найден"},
+        400: {"model": ErrorResponse, "description": "Неверный формат thread_id или snapshot вместе с all_posts"}
     },
     summary="Получить информацию о треде",
     description="Возвращает данные треда из локального файла (если тред был загружен)"
 )
-async def get_thread_info(thread_id: str):
+async def get_thread_info(
+    thread_id: str,
+    snapshot: Optional[int] = Query(None, description="Номер снимка (отрицательный — с конца)"),
+    all_posts: bool = Query(False, description="Все когда-либо виденные посты, включая удаленные")
+):
     """
     Получает информацию о треде из локального файла.
     
     - **thread_id**: ID треда на 2ch.hk (только цифры)
+    - **snapshot**: вернуть тред на момент снимка из истории
+    - **all_posts**: вернуть объединение всех снимков
     """
     # Валидация thread_id
     if not thread_id.isdigit():
@@ -226,6 +239,12 @@ async def get_thread_info(thread_id: str):
             detail="thread_id должен содержать только цифры"
         )
     
+    if all_posts and snapshot is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="Параметры snapshot и all_posts нельзя передавать вместе"
+        )
+    
     # Проверяем существование файла треда
     thread_path = Path(f'downloads/{thread_id}/{thread_id}.json')
     if not thread_path.exists():
@@ -235,10 +254,21 @@ async def get_thread_info(thread_id: str):
         )
     
     try:
+        # Восстановление из истории читает диск, не блокируем им event loop
+        if all_posts:
+            return await run_in_threadpool(get_thread_union, thread_path.parent)
+        if snapshot is not None:
+            return await run_in_threadpool(get_thread_at, thread_path.parent, snapshot)
+
         with open(thread_path, 'r', encoding='utf-8') as f:
             thread_data = json.load(f)
         
         return thread_data
+    except (FileNotFoundError, IndexError) as e:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Снимок треда {thread_id} не найден: {str(e)}"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -246,6 +276,37 @@ async def get_thread_info(thread_id: str):
         )
 
 
+@app.get(
+    "/thread/{thread_id}/snapshots",
+    responses={
+        200: {"description": "Список снимков получен"},
+        404: {"model": ErrorResponse, "description": "История снимков не найдена"},
+        400: {"model": ErrorResponse, "description": "Неверный формат thread_id"}
+    },
+    summary="Получить список снимков треда",
+    description="Возвращает снимки треда с количеством добавленных, измененных и удаленных постов"
+)
+async def get_thread_snapshots(thread_id: str):
+    """
+    Получает историю снимков треда.
+    
+    - **thread_id**: ID треда на 2ch.hk (только цифры)
+    """
+    if not thread_id.isdigit():
+        raise HTTPException(
+            status_code=400,
+            detail="thread_id должен содержать только цифры"
+        )
+    
+    try:
+        return await run_in_threadpool(list_snapshots, Path(f'downloads/{thread_id}'))
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=404,
+            detail=f"История снимков треда {thread_id} не найдена"
+        )
+
+
 @app.get(
     "/",
     summary="Корневой эндпоинт",
@@ -260,6 +321,7 @@ async def root():
             "download": "POST /download/{thread_id}",
             "status": "GET /status/{thread_id}",
             "thread": "GET /thread/{thread_id}",
+            "snapshots": "GET /thread/{thread_id}/snapshots",
             "health": "GET /health"
         },
         "docs": "/docs",
@@ -0,0 +1,92 @@
+"""Бенчмарк восстановления треда из истории снимков.
+
+Генерирует тред, который между снимками получает новые посты, теряет
+удаленные и редактирует часть старых, и замеряет время get_thread_at
+(первый и последний снимок) и get_thread_union в зависимости от числа снимков.
+
+Запуск: python bench_snapshots.py [--posts-per-snapshot 20] [--repeat 5]
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from snapshots import SNAPSHOTS_FILE, get_thread_at, get_thread_union, record_snapshot
+
+SNAPSHOT_COUNTS = [1, 10, 50, 100, 250, 500, 1000]
+
+
+def make_post(num: int) -> dict:
+    return {
+        'num': num,
+        'parent': 0 if num == 1 else 1,
+        'timestamp': 1700000000 + num,
+        'name': 'Аноним',
+        'comment': f'Пост {num} ' + 'текст ' * random.randint(5, 60),
+        'files': [{'path': f'/b/src/1/{num}.jpg', 'thumbnail': f'/b/thumb/1/{num}s.jpg'}] if num % 3 == 0 else [],
+    }
+
+
+def make_doc(posts: dict) -> dict:
+    return {
+        'advert_top_image': f'/banners/{random.getrandbits(32):08x}.jpeg',
+        'board': {'id': 'b', 'name': 'Бред', 'bump_limit': 500, 'max_pages': 10},
+        'posts_count': len(posts),
+        'threads': [{'posts': [posts[num] for num in sorted(posts)]}],
+    }
+
+
+def build_history(thread_dir: Path, snapshots: int, posts_per_snapshot: int):
+    posts = {num: make_post(num) for num in range(1, posts_per_snapshot + 1)}
+    next_num = posts_per_snapshot + 1
+    previous = None
+    for _ in range(snapshots):
+        current = make_doc(posts)
+        record_snapshot(thread_dir, previous, current)
+        previous = current
+
+        for _ in range(posts_per_snapshot):
+            posts[next_num] = make_post(next_num)
+            next_num += 1
+        for num in random.sample(sorted(posts)[1:], k=min(2, len(posts) - 1)):
+            del posts[num]
+        edited = random.choice(sorted(posts))
+        posts[edited] = dict(posts[edited], comment=posts[edited]['comment'] + ' (ред.)')
+
+
+def timed(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts-per-snapshot', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{'снимков':>8} {'постов':>8} {'история, КБ':>12} {'снимок 0, мс':>13} "
+          f"{'последний, мс':>14} {'объединение, мс':>16}")
+    for count in SNAPSHOT_COUNTS:
+        with tempfile.TemporaryDirectory() as tmp:
+            thread_dir = Path(tmp)
+            build_history(thread_dir, count, args.posts_per_snapshot)
+            size_kb = (thread_dir / SNAPSHOTS_FILE).stat().st_size / 1024
+
+            latest = get_thread_at(thread_dir, -1)
+            posts = len(latest['threads'][0]['posts'])
+            first_ms = timed(lambda: get_thread_at(thread_dir, 0), args.repeat) * 1000
+            at_ms = timed(lambda: get_thread_at(thread_dir, -1), args.repeat) * 1000
+            union_ms = timed(lambda: get_thread_union(thread_dir), args.repeat) * 1000
+
+        print(f'{count:>8} {posts:>8} {size_kb:>12.1f} {first_ms:>13.2f} {at_ms:>14.2f} {union_ms:>16.2f}')
+
+
+if __name__ == '__main__':
+    main()
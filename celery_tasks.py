@@ -3,12 +3,17 @@ import json
 import asyncio
 from celery import Celery
 from celery.result import AsyncResult
+from celery.utils.log import get_task_logger
 from pathlib import Path
 import aiohttp
 import aiofiles
 from datetime import datetime
 from typing import Dict, Any
 
+from snapshots import record_snapshot
+
+logger = get_task_logger(__name__)
+
 # Получаем URL для Redis из переменных окружения
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
@@ -40,6 +45,15 @@ headers = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36'
 }
 
+# Файл с адресом источника треда, нужен для догрузки оригиналов по запросу
+SOURCE_FILE = '.source.json'
+
+# Ленивый режим: через сколько секунд после архивации догружать оригиналы
+# и сколько файлов качать одновременно, чтобы не мешать загрузкам по запросу
+LAZY_PREFETCH_DELAY = int(os.environ.get('LAZY_PREFETCH_DELAY', '300'))
+LAZY_PREFETCH_CONCURRENCY = int(os.environ.get('LAZY_PREFETCH_CONCURRENCY', '2'))
+# Сколько раз повторять догрузку (с удвоением задержки), пока тред жив на источнике
+LAZY_PREFETCH_RETRIES = int(os.environ.get('LAZY_PREFETCH_RETRIES', '5'))
 
 
 async def fetch_and_save_json(session, thread_id, save_dir, base_url):
@@ -50,23 +64,76 @@ async def fetch_and_save_json(session, thread_id, save_dir, base_url):
         data_text = await resp.text()
 
     json_path = save_dir / f"{thread_id}.json"
-    async with aiofiles.open(json_path, 'w', encoding='utf-8') as f:
+    previous = None
+    if json_path.exists():
+        async with aiofiles.open(json_path, 'r', encoding='utf-8') as f:
+            try:
+                previous = json.loads(await f.read())
+            except ValueError:
+                # Файл обрезан прерванной записью, дельта все равно считается от истории
+                previous = None
+
+    data = json.loads(data_text)
+    # Сохраняем дельту до перезаписи, чтобы удаленные посты остались в истории.
+    # Ошибка истории не должна мешать сохранить сам тред.
+    try:
+        record_snapshot(save_dir, previous, data)
+    except Exception:
+        logger.exception('Не удалось записать снимок треда %s', thread_id)
+
+    # Пишем во временный файл, чтобы прерванная запись не испортила тред
+    part_path = save_dir / f'.{thread_id}.json.{os.getpid()}.part'
+    async with aiofiles.open(part_path, 'w', encoding='utf-8') as f:
         await f.write(data_text)
+    os.replace(part_path, json_path)
+
+    return data
+
 
-    return json.loads(data_text)
+async def save_source(save_dir, base_url, lazy):
+    """Сохранение адреса источника треда"""
+    source_path = save_dir / SOURCE_FILE
+    async with aiofiles.open(source_path, 'w', encoding='utf-8') as f:
+        await f.write(json.dumps({'base_url': base_url, 'lazy': lazy}))
 
 
-async def handle_download(session, url, dest_path, is_original, sem, stats, failures):
+def collect_media_tasks(posts, base_url, base_dir, thumb_dir):
+    """Список файлов треда для загрузки: (url, dest, is_original)"""
+    tasks_info = []
+    for post in posts:
+        for file in post.get('files', []) or []:
+            path = file.get('path', '')
+            thumb = file.get('thumbnail', '')
+            if not path:
+                continue
+
+            tasks_info.append((base_url + path, str(base_dir / Path(path).name), True))
+
+            if thumb:
+                tasks_info.append((base_url + thumb, str(thumb_dir / Path(thumb).name), False))
+
+    return tasks_info
+
+
+async def handle_download(session, url, dest_path, is_original, sem, stats, failures, skip_existing=False):
     """Загрузка отдельного файла"""
+    dest_dir, dest_name = os.path.split(dest_path)
+    part_path = os.path.join(dest_dir, f'.{dest_name}.{os.getpid()}.part')
     async with sem:
+        # Проверяем уже под семафором: пока задача ждала очереди,
+        # файл мог скачаться по запросу через /b/src/
+        if skip_existing and os.path.exists(dest_path):
+            return
         try:
             async with session.get(url, headers=headers) as resp:
                 resp.raise_for_status()
                 os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                async with aiofiles.open(dest_path, 'wb') as f:
+                # Пишем во временный файл, чтобы nginx не отдал недокачанный
+                async with aiofiles.open(part_path, 'wb') as f:
                     async for chunk in resp.content.iter_chunked(1024):
                         await f.write(chunk)
-            
+            os.replace(part_path, dest_path)
+
             if is_original:
                 ext = Path(dest_path).suffix.lower()
                 if ext in IMAGE_EXTENSIONS:
@@ -76,11 +143,17 @@ async def handle_download(session, url, dest_path, is_original, sem, stats, fail
                 else:
                     stats['other'] += 1
         except Exception as e:
+            if os.path.exists(part_path):
+                os.remove(part_path)
             failures.append((url, dest_path, is_original))
 
 
-async def download_thread_async(thread_id: str, task, base_url: str) -> Dict[str, Any]:
-    """Асинхронная функция загрузки треда"""
+async def download_thread_async(thread_id: str, task, base_url: str, lazy: bool = False) -> Dict[str, Any]:
+    """Асинхронная функция загрузки треда
+
+    В ленивом режиме сохраняются только JSON и превью, оригиналы отдаются
+    через /b/src/ по первому запросу и догружаются фоновой задачей.
+    """
     base_dir = Path(f'downloads/{thread_id}')
     thumb_dir = base_dir / 'thumb'
     base_dir.mkdir(parents=True, exist_ok=True)
@@ -91,6 +164,7 @@ async def download_thread_async(thread_id: str, task, base_url: str) -> Dict[str
         'status': 'processing',
         'started_at': datetime.utcnow().isoformat(),
         'stats': {'photos': 0, 'videos': 0, 'other': 0, 'total': 0},
+        'lazy': lazy,
         'errors': []
     }
 
@@ -103,42 +177,15 @@ async def download_thread_async(thread_id: str, task, base_url: str) -> Dict[str
             )
             
             data = await fetch_and_save_json(session, thread_id, base_dir, base_url)
+            await save_source(base_dir, base_url, lazy)
             threads = data.get('threads', [])
             posts = threads[0].get('posts', []) if threads else []
 
-            # Подсчет файлов
-            tasks_info = []
-            initial_counts = {'photos': 0, 'videos': 0, 'other': 0}
-            
-            for post in posts:
-                for file in post.get('files', []) or []:
-                    path = file.get('path', '')
-                    thumb = file.get('thumbnail', '')
-                    if not path:
-                        continue
-                    
-                    url_full = base_url + path
-                    fname = Path(path).name
-                    dest = base_dir / fname
-                    ext = Path(fname).suffix.lower()
-                    
-                    if ext in IMAGE_EXTENSIONS:
-                        initial_counts['photos'] += 1
-                    elif ext in VIDEO_EXTENSIONS:
-                        initial_counts['videos'] += 1
-                    else:
-                        initial_counts['other'] += 1
-                    
-                    tasks_info.append((url_full, str(dest), True))
-
-                    if thumb:
-                        url_thumb = base_url + thumb
-                        fname_thumb = Path(thumb).name
-                        dest_thumb = thumb_dir / fname_thumb
-                        tasks_info.append((url_thumb, str(dest_thumb), False))
-
+            tasks_info = collect_media_tasks(posts, base_url, base_dir, thumb_dir)
             total_files = len([t for t in tasks_info if t[2]])  # Только оригиналы
-            
+            if lazy:
+                tasks_info = [t for t in tasks_info if not t[2]]
+
             # Обновляем статус: начало загрузки файлов
             task.update_state(
                 state='PROGRESS',
@@ -167,7 +214,12 @@ async def download_thread_async(thread_id: str, task, base_url: str) -> Dict[str
                 
                 # Обновляем прогресс
                 downloaded = stats['photos'] + stats['videos'] + stats['other']
-                progress = 10 + int((downloaded / total_files) * 85) if total_files > 0 else 95
+                if lazy:
+                    # Оригиналы не качаются, прогресс считаем по превью
+                    done = min(i + batch_size, len(tasks_info))
+                    progress = 10 + int((done / len(tasks_info)) * 85)
+                else:
+                    progress = 10 + int((downloaded / total_files) * 85) if total_files > 0 else 95
                 
                 task.update_state(
                     state='PROGRESS',
@@ -205,6 +257,13 @@ async def download_thread_async(thread_id: str, task, base_url: str) -> Dict[str
             result['status'] = 'completed'
             result['completed_at'] = datetime.utcnow().isoformat()
 
+            if lazy:
+                result['deferred'] = total_files
+                prefetch = prefetch_originals.apply_async(
+                    (thread_id, base_url), countdown=LAZY_PREFETCH_DELAY
+                )
+                result['prefetch_task_id'] = prefetch.id
+
     except Exception as e:
         result['status'] = 'failed'
         result['error'] = str(e)
@@ -214,18 +273,110 @@ async def download_thread_async(thread_id: str, task, base_url: str) -> Dict[str
     return result
 
 
+async def fetch_thread_status(session, thread_id, base_url):
+    """HTTP-статус треда на источнике или None, если источник недоступен"""
+    url = f'{base_url}/b/res/{thread_id}.json'
+    try:
+        async with session.get(url, headers=headers) as resp:
+            return resp.status
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+async def prefetch_originals_async(thread_id: str, base_url: str) -> Dict[str, Any]:
+    """Фоновая догрузка оригиналов, которые еще не скачаны по запросу"""
+    base_dir = Path(f'downloads/{thread_id}')
+    json_path = base_dir / f'{thread_id}.json'
+
+    result = {
+        'thread_id': thread_id,
+        'status': 'processing',
+        'started_at': datetime.utcnow().isoformat(),
+        'stats': {'photos': 0, 'videos': 0, 'other': 0, 'total': 0},
+        'errors': []
+    }
+
+    async with aiofiles.open(json_path, 'r', encoding='utf-8') as f:
+        data = json.loads(await f.read())
+    threads = data.get('threads', [])
+    posts = threads[0].get('posts', []) if threads else []
+
+    tasks_info = [
+        t for t in collect_media_tasks(posts, base_url, base_dir, base_dir / 'thumb')
+        if t[2]
+    ]
+
+    stats = {'photos': 0, 'videos': 0, 'other': 0}
+    failures = []
+    sem = asyncio.Semaphore(LAZY_PREFETCH_CONCURRENCY)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[
+            handle_download(session, url, dest, is_original, sem, stats, failures, skip_existing=True)
+            for url, dest, is_original in tasks_info
+        ])
+
+        # Повторная попытка для неудавшихся, кроме уже скачанных по запросу
+        if failures:
+            retry_failures = []
+            await asyncio.gather(*[
+                handle_download(session, url, dest, is_original, sem, stats, retry_failures, skip_existing=True)
+                for url, dest, is_original in failures
+            ])
+            result['errors'] = [
+                {'url': url, 'dest': dest}
+                for url, dest, _ in retry_failures
+            ]
+
+        if result['errors']:
+            result['upstream_status'] = await fetch_thread_status(session, thread_id, base_url)
+
+    result['stats'] = {
+        'photos': stats['photos'],
+        'videos': stats['videos'],
+        'other': stats['other'],
+        'total': stats['photos'] + stats['videos'] + stats['other']
+    }
+    result['status'] = 'completed'
+    result['completed_at'] = datetime.utcnow().isoformat()
+    return result
+
+
 @celery_app.task(bind=True, name='download_thread')
-def download_thread(self, thread_id: str, base_url: str = 'https://2ch.org') -> Dict[str, Any]:
+def download_thread(self, thread_id: str, base_url: str = 'https://2ch.org', lazy: bool = False) -> Dict[str, Any]:
     """Celery задача для загрузки треда"""
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
-        result = loop.run_until_complete(download_thread_async(thread_id, self, base_url))
+        result = loop.run_until_complete(download_thread_async(thread_id, self, base_url, lazy))
         return result
     finally:
         loop.close()
 
 
+@celery_app.task(bind=True, name='prefetch_originals')
+def prefetch_originals(self, thread_id: str, base_url: str = 'https://2ch.org') -> Dict[str, Any]:
+    """Celery задача для фоновой догрузки оригиналов ленивого треда
+
+    Пока часть файлов не скачана, а тред еще не удален на источнике,
+    задача перезапускается с удваивающейся задержкой.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(prefetch_originals_async(thread_id, base_url))
+    finally:
+        loop.close()
+
+    if (result['errors'] and result.get('upstream_status') not in (404, 410)
+            and self.request.retries < LAZY_PREFETCH_RETRIES):
+        raise self.retry(
+            countdown=LAZY_PREFETCH_DELAY * 2 ** self.request.retries,
+            max_retries=LAZY_PREFETCH_RETRIES
+        )
+    return result
+
+
 def get_task_info(task_id: str) -> Dict[str, Any]:
     """Получение информации о задаче"""
     result = AsyncResult(task_id, app=celery_app)
@@ -2,13 +2,29 @@
 import os
 import random
 import json
+import asyncio
+import mimetypes
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
 
+import aiofiles
+import aiohttp
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if _http_session is not None:
+        await _http_session.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS: разрешаем все источники только для GET-запросов под /b/*
 app.add_middleware(
@@ -21,6 +37,24 @@ app.add_middleware(
 # Шаблоны и статика
 templates = Jinja2Templates(directory="templates")
 
+DOWNLOADS_ROOT = Path("downloads")
+SOURCE_FILE = ".source.json"  # пишется celery_tasks.save_source
+MEDIA_CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000"}
+STREAM_CHUNK_SIZE = 64 * 1024
+# Сколько секунд помнить, что источник ответил 404, чтобы не ходить туда на каждый просмотр
+MISSING_CACHE_TTL = 600
+
+UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36'
+}
+
+_http_session: Optional[aiohttp.ClientSession] = None
+_inflight: Dict[str, "_InflightFetch"] = {}
+# thread_id -> (mtime JSON треда, имя файла -> URL на источнике)
+_source_urls: Dict[str, Tuple[int, Dict[str, str]]] = {}
+# путь файла -> время (time.monotonic), до которого считаем его удаленным на источнике
+_missing: Dict[str, float] = {}
+
 
 def get_random_gif(static_folder: str = "static") -> str:
     if not os.path.isdir(static_folder):
@@ -33,6 +67,166 @@ def get_random_gif(static_folder: str = "static") -> str:
     return f"/static/{chosen}"
 
 
+class _InflightFetch:
+    """Загрузка оригинала с источника, которую читают все клиенты, запросившие файл"""
+
+    def __init__(self, dest: Path):
+        self.dest = dest
+        self.part = dest.with_name(f".{dest.name}.{os.getpid()}.part")
+        self.size = 0
+        self.content_length: Optional[int] = None
+        self.content_type: Optional[str] = None
+        self.error: Optional[Exception] = None
+        self.done = False
+        self.started = asyncio.Event()
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def upstream_missing(self) -> bool:
+        """Источник ответил, что файла нет (удален вместе с тредом)"""
+        return isinstance(self.error, aiohttp.ClientResponseError) and self.error.status in (404, 410)
+
+    async def run(self, session: aiohttp.ClientSession, url: str):
+        try:
+            async with session.get(url, headers=UPSTREAM_HEADERS) as resp:
+                resp.raise_for_status()
+                if "Content-Encoding" not in resp.headers:
+                    self.content_length = resp.content_length
+                self.content_type = resp.headers.get("Content-Type")
+                async with aiofiles.open(self.part, "wb") as f:
+                    self.started.set()
+                    async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        await f.write(chunk)
+                        await f.flush()
+                        async with self.changed:
+                            self.size += len(chunk)
+                            self.changed.notify_all()
+            os.replace(self.part, self.dest)
+        except Exception as e:
+            self.error = e
+            if self.part.exists():
+                os.remove(self.part)
+            if self.upstream_missing:
+                _missing[str(self.dest)] = time.monotonic() + MISSING_CACHE_TTL
+        finally:
+            _inflight.pop(str(self.dest), None)
+            self.done = True
+            self.started.set()
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def stream(self, f):
+        """Отдает клиенту уже записанную часть файла и дожидается остальной"""
+        sent = 0
+        try:
+            while True:
+                if sent < self.size:
+                    chunk = await f.read(min(self.size - sent, STREAM_CHUNK_SIZE))
+                    sent += len(chunk)
+                    yield chunk
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    break
+                async with self.changed:
+                    await self.changed.wait_for(lambda: self.size > sent or self.done)
+        finally:
+            await f.close()
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession()
+    return _http_session
+
+
+def _load_source_urls(thread_dir: Path, thread_id: str) -> Dict[str, str]:
+    """Карта имя файла -> URL оригинала на источнике для сохраненного треда"""
+    with open(thread_dir / SOURCE_FILE, "r", encoding="utf-8") as f:
+        base_url = json.load(f)["base_url"]
+    with open(thread_dir / f"{thread_id}.json", "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    urls = {}
+    for thread in data.get("threads", []):
+        for post in thread.get("posts", []):
+            for file in post.get("files", []) or []:
+                path = file.get("path", "")
+                if path:
+                    urls[Path(path).name] = base_url + path
+    return urls
+
+
+async def resolve_source_url(thread_id: str, filename: str) -> str:
+    """URL оригинала на источнике, только для файлов из сохраненного треда"""
+    if not thread_id.isdigit() or filename != Path(filename).name or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    thread_dir = DOWNLOADS_ROOT / thread_id
+    try:
+        mtime = (thread_dir / f"{thread_id}.json").stat().st_mtime_ns
+        cached = _source_urls.get(thread_id)
+        if cached is None or cached[0] != mtime:
+            # Разбор JSON большого треда не должен блокировать идущие стримы
+            cached = (mtime, await run_in_threadpool(_load_source_urls, thread_dir, thread_id))
+            _source_urls[thread_id] = cached
+    except (OSError, ValueError, KeyError):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    url = cached[1].get(filename)
+    if url is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return url
+
+
+@app.get("/b/src/{thread_id}/{filename}")
+async def fetch_through_media(thread_id: str, filename: str):
+    """Отдача оригинала, которого нет на диске (nginx try_files промахнулся).
+
+    Файл качается с источника один раз: он сразу стримится клиенту и пишется
+    на диск, а параллельные запросы того же файла читают ту же загрузку.
+    """
+    url = await resolve_source_url(thread_id, filename)
+    dest = DOWNLOADS_ROOT / thread_id / filename
+    if dest.is_file():
+        return FileResponse(dest, headers=MEDIA_CACHE_HEADERS)
+
+    expires = _missing.get(str(dest))
+    if expires is not None:
+        if expires > time.monotonic():
+            raise HTTPException(status_code=404, detail="Файл удален на источнике")
+        del _missing[str(dest)]
+
+    fetch = _inflight.get(str(dest))
+    if fetch is None:
+        fetch = _InflightFetch(dest)
+        _inflight[str(dest)] = fetch
+        fetch.task = asyncio.create_task(fetch.run(_get_http_session(), url))
+
+    await fetch.started.wait()
+    if fetch.upstream_missing:
+        raise HTTPException(status_code=404, detail="Файл удален на источнике")
+    if fetch.error is not None:
+        raise HTTPException(status_code=502, detail=f"Не удалось загрузить файл с источника: {fetch.error}")
+
+    try:
+        f = await aiofiles.open(fetch.part, "rb")
+    except FileNotFoundError:
+        # Загрузка успела завершиться, файл уже переименован
+        if fetch.error is not None or not dest.is_file():
+            raise HTTPException(status_code=502, detail="Не удалось загрузить файл с источника")
+        return FileResponse(dest, headers=MEDIA_CACHE_HEADERS)
+
+    headers = dict(MEDIA_CACHE_HEADERS)
+    if fetch.content_length is not None:
+        headers["Content-Length"] = str(fetch.content_length)
+    media_type = fetch.content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return StreamingResponse(fetch.stream(f), media_type=media_type, headers=headers)
+
+
 @app.get("/")
 async def root():
     return RedirectResponse(url="/b/catalog.html")
@@ -0,0 +1,282 @@
+import json
+import os
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# История снимков треда: строки с полным документом (base) и между ними дельты по постам.
+# Файл только дописывается, поэтому каждый снимок стоит столько, сколько в нем изменений.
+SNAPSHOTS_FILE = '.snapshots.jsonl'
+
+# Каждый CHECKPOINT_INTERVAL-й снимок пишется полностью, чтобы восстановление
+# не разбирало всю историю, а начинало с ближайшей контрольной точки
+CHECKPOINT_INTERVAL = 50
+BASE_PREFIX = b'{"base"'
+
+# Поля треда, которые меняются почти при каждой загрузке и сами по себе снимка не стоят
+VOLATILE_PREFIXES = ('advert_',)
+
+
+def _split(doc: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[int, Dict[str, Any]]]:
+    """Разделение документа треда на каркас без постов и посты по num"""
+    skeleton = dict(doc)
+    threads = [dict(t) for t in doc.get('threads', [])]
+    posts = {}
+    if threads:
+        posts = {p['num']: p for p in threads[0].get('posts', []) or []}
+        threads[0]['posts'] = []
+    skeleton['threads'] = threads
+    return skeleton, posts
+
+
+def _join(skeleton: Dict[str, Any], posts: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    """Сборка документа треда из каркаса и постов"""
+    doc = dict(skeleton)
+    threads = [dict(t) for t in skeleton.get('threads', [])]
+    if threads:
+        threads[0]['posts'] = [posts[num] for num in sorted(posts)]
+    doc['threads'] = threads
+    return doc
+
+
+def diff_snapshot(previous: Dict[str, Any], current: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Дельта между двумя снимками треда или None, если значимых изменений нет"""
+    prev_skeleton, prev_posts = _split(previous)
+    skeleton, posts = _split(current)
+
+    delta = {
+        'added': [p for num, p in posts.items() if num not in prev_posts],
+        'edited': [p for num, p in posts.items() if num in prev_posts and prev_posts[num] != p],
+        'removed': [num for num in prev_posts if num not in posts],
+        'meta': {key: value for key, value in skeleton.items() if prev_skeleton.get(key) != value},
+        'meta_removed': [key for key in prev_skeleton if key not in skeleton],
+    }
+    delta = {key: value for key, value in delta.items() if value}
+
+    changed_keys = list(delta.get('meta', {})) + delta.get('meta_removed', [])
+    if all(key.startswith(VOLATILE_PREFIXES) for key in changed_keys) and not (
+            delta.keys() & {'added', 'edited', 'removed'}):
+        return None
+
+    return delta
+
+
+def _parse(line: Union[bytes, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Запись истории или None, если строка недописана"""
+    if isinstance(line, dict):
+        return line
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _is_base(line: Union[bytes, Dict[str, Any]]) -> bool:
+    if isinstance(line, dict):
+        return 'base' in line
+    return line.startswith(BASE_PREFIX)
+
+
+def _cut_partial_line(f):
+    """Обрезка последней строки, если запись в историю прервалась на середине"""
+    end = f.seek(0, os.SEEK_END)
+    if end == 0:
+        return
+    f.seek(end - 1)
+    if f.read(1) == b'\n':
+        return
+    pos = end
+    while pos > 0:
+        step = min(1 << 16, pos)
+        pos -= step
+        f.seek(pos)
+        newline = f.read(step).rfind(b'\n')
+        if newline != -1:
+            f.truncate(pos + newline + 1)
+            return
+    f.truncate(0)
+
+
+def _append(thread_dir: Path, entry: Dict[str, Any]):
+    path = thread_dir / SNAPSHOTS_FILE
+    with open(path, 'r+b' if path.exists() else 'wb') as f:
+        _cut_partial_line(f)
+        f.seek(0, os.SEEK_END)
+        f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+def _read_lines(thread_dir: Path, stop: Optional[int] = None) -> List[bytes]:
+    """Строки истории без разбора JSON, не дальше снимка с номером stop - 1"""
+    with open(thread_dir / SNAPSHOTS_FILE, 'rb') as f:
+        lines = [line for line in islice(f, stop) if line.strip()]
+    if not lines:
+        raise FileNotFoundError(f'История снимков пуста: {thread_dir / SNAPSHOTS_FILE}')
+    return lines
+
+
+def _checkpoint_before(lines: List[Union[bytes, Dict[str, Any]]], index: int) -> int:
+    """Номер ближайшего полного снимка не позже index (первая строка всегда полная)"""
+    while index > 0 and not _is_base(lines[index]):
+        index -= 1
+    return index
+
+
+def _reverse_lines(f, block_size: int = 1 << 20):
+    """Непустые строки файла с конца, без чтения всего файла"""
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    pending = []  # куски строки, которая началась раньше прочитанного блока
+    while pos > 0:
+        step = min(block_size, pos)
+        pos -= step
+        f.seek(pos)
+        parts = f.read(step).split(b'\n')
+        if len(parts) == 1:
+            pending.append(parts[0])
+            continue
+        parts[-1] += b''.join(reversed(pending))
+        for line in reversed(parts[1:]):
+            if line.strip():
+                yield line
+        pending = [parts[0]]
+    line = b''.join(reversed(pending))
+    if line.strip():
+        yield line
+
+
+def _read_tail(thread_dir: Path, count: int) -> List[Union[bytes, Dict[str, Any]]]:
+    """Последние count строк истории вместе со строками до ближайшего целого полного снимка
+
+    Найденный полный снимок возвращается уже разобранным, чтобы не разбирать его дважды.
+    """
+    tail = []
+    with open(thread_dir / SNAPSHOTS_FILE, 'rb') as f:
+        for line in _reverse_lines(f):
+            if len(tail) + 1 >= count and line.startswith(BASE_PREFIX):
+                entry = _parse(line)
+                if entry is not None:
+                    tail.append(entry)
+                    break
+            tail.append(line)
+    if not tail:
+        raise FileNotFoundError(f'История снимков пуста: {thread_dir / SNAPSHOTS_FILE}')
+    tail.reverse()
+    return tail
+
+
+def _replay(lines: List[Union[bytes, Dict[str, Any]]], index: int, keep_removed: bool) -> Dict[str, Any]:
+    start = _checkpoint_before(lines, index)
+    base = _parse(lines[start])
+    # Недописанный полный снимок пропускаем и начинаем с предыдущего
+    while base is None or 'base' not in base:
+        if start == 0:
+            raise ValueError('В истории снимков нет целого полного снимка')
+        start = _checkpoint_before(lines, start - 1)
+        base = _parse(lines[start])
+
+    skeleton, posts = _split(base['base'])
+    if keep_removed:
+        for post in base.get('deleted', []):
+            posts.setdefault(post['num'], post)
+
+    for line in lines[start + 1:index + 1]:
+        entry = _parse(line)
+        if entry is None or 'base' in entry:
+            continue
+        skeleton.update(entry.get('meta', {}))
+        for key in entry.get('meta_removed', []):
+            skeleton.pop(key, None)
+        for post in entry.get('added', []):
+            posts[post['num']] = post
+        for post in entry.get('edited', []):
+            posts[post['num']] = post
+        if not keep_removed:
+            for num in entry.get('removed', []):
+                posts.pop(num, None)
+    return _join(skeleton, posts)
+
+
+def record_snapshot(thread_dir: Path, previous: Optional[Dict[str, Any]], current: Dict[str, Any]) -> bool:
+    """Запись нового снимка треда в историю
+
+    Дельта считается от последнего снимка истории, а не от файла на диске.
+    previous — документ, который лежал на диске до перезаписи; он нужен только
+    тредам, скачанным до появления истории, и становится их базовым снимком.
+    Возвращает False, если тред не изменился.
+    """
+    taken_at = datetime.utcnow().isoformat()
+
+    if not (thread_dir / SNAPSHOTS_FILE).exists() and previous is not None:
+        _append(thread_dir, {'base': previous, 'taken_at': None})
+
+    try:
+        lines = _read_tail(thread_dir, 1)
+        last = len(lines) - 1
+        latest = _replay(lines, last, keep_removed=False)
+    except (FileNotFoundError, ValueError):
+        # Истории нет или в ней не осталось целого полного снимка, начинаем с текущего
+        _append(thread_dir, {'base': current, 'taken_at': taken_at})
+        return True
+
+    delta = diff_snapshot(latest, current)
+    if delta is None:
+        return False
+
+    if last + 1 - _checkpoint_before(lines, last) >= CHECKPOINT_INTERVAL:
+        # Контрольная точка хранит и удаленные посты, чтобы объединение тоже начиналось с нее
+        _, seen = _split(_replay(lines, last, keep_removed=True))
+        _, posts = _split(current)
+        _append(thread_dir, {
+            'base': current,
+            'deleted': [post for num, post in seen.items() if num not in posts],
+            'delta_counts': {key: len(delta.get(key, [])) for key in ('added', 'edited', 'removed')},
+            'taken_at': taken_at,
+        })
+    else:
+        delta['taken_at'] = taken_at
+        _append(thread_dir, delta)
+    return True
+
+
+def list_snapshots(thread_dir: Path) -> List[Dict[str, Any]]:
+    """Краткое описание снимков без самих постов"""
+    summary = []
+    for index, line in enumerate(_read_lines(thread_dir)):
+        entry = _parse(line)
+        if entry is None:
+            continue
+        if 'base' in entry:
+            _, posts = _split(entry['base'])
+            counts = entry.get('delta_counts', {'added': len(posts), 'edited': 0, 'removed': 0})
+            summary.append({'snapshot': index, 'taken_at': entry['taken_at'], 'base': True,
+                            'posts': len(posts), **counts})
+        else:
+            summary.append({
+                'snapshot': index,
+                'taken_at': entry['taken_at'],
+                'base': False,
+                'added': len(entry.get('added', [])),
+                'edited': len(entry.get('edited', [])),
+                'removed': len(entry.get('removed', [])),
+            })
+    return summary
+
+
+def get_thread_at(thread_dir: Path, snapshot: int) -> Dict[str, Any]:
+    """Документ треда на момент снимка (отрицательный номер считается с конца)"""
+    if snapshot >= 0:
+        lines = _read_lines(thread_dir, snapshot + 1)
+        index = snapshot
+    else:
+        lines = _read_tail(thread_dir, -snapshot)
+        index = len(lines) + snapshot
+    if not 0 <= index < len(lines):
+        raise IndexError(f'Снимок {snapshot} не найден')
+    return _replay(lines, index, keep_removed=False)
+
+
+def get_thread_union(thread_dir: Path) -> Dict[str, Any]:
+    """Документ треда со всеми когда-либо виденными постами в последней редакции"""
+    lines = _read_tail(thread_dir, 1)
+    return _replay(lines, len(lines) - 1, keep_removed=True)